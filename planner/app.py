@@ -1,17 +1,21 @@
 import os
-import json
 import uuid
 import logging
 import time
 import asyncio
 import re
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from itertools import islice
 from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Body, Depends, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 
+import msgspec
+import orjson
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ParamValidationError
@@ -27,24 +31,71 @@ MODEL_ID = os.getenv("BEDROCK_MODEL_ID", "eu.amazon.nova-pro-v1:0")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger("planner")
 
-app = FastAPI(title="Planner + Chat + Codegen (trace)", version="4.4.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Bind the serving loop for trace() and run the idle-queue reaper (TRACE BUS below)
+    global _LOOP
+    _LOOP = asyncio.get_running_loop()
+    reaper = asyncio.create_task(_reap_idle_queues())
+    try:
+        yield
+    finally:
+        reaper.cancel()
+        try:
+            await reaper
+        except asyncio.CancelledError:
+            pass
+
+app = FastAPI(
+    title="Planner + Chat + Codegen (trace)",
+    version="4.4.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+
+_ROUTES_CACHE: Optional[List[Optional[str]]] = None  # routes are fixed once the app is serving
 
 @app.get("/__routes")
 def __routes():
-    return {"paths": [getattr(r, "path", None) for r in app.routes]}
+    global _ROUTES_CACHE
+    if _ROUTES_CACHE is None:
+        _ROUTES_CACHE = [getattr(r, "path", None) for r in app.routes]
+    return {"paths": _ROUTES_CACHE}
 
 # =============================
 # Bedrock helper
 # =============================
+@lru_cache(maxsize=1)
+def _boto_session(region: str) -> boto3.Session:
+    # Credential resolution (env, SSO, IMDS) runs once per process
+    return boto3.Session(region_name=region)
+
 class BedrockClient:
     def __init__(self, model_id: str, region: str):
         self.model_id = model_id
         # ⏱ Tighter client timeouts so the UI never hangs forever
-        self.client = boto3.client(
+        self.client = _boto_session(region).client(
             "bedrock-runtime",
-            region_name=region,
-            config=Config(connect_timeout=3, read_timeout=20, retries={"max_attempts": 2}),
+            config=Config(
+                connect_timeout=3,
+                read_timeout=20,
+                retries={"max_attempts": 2, "mode": "adaptive"},
+                # Keep warm sockets alive across concurrent requests instead of re-handshaking TLS
+                tcp_keepalive=True,
+                max_pool_connections=64,
+            ),
         )
+        self._base_reqs: Dict[Optional[str], Dict[str, Any]] = {}
+
+    def _precomposed_req(self, system_prompt: Optional[str]) -> Dict[str, Any]:
+        # modelId/system are fixed per prompt; build them once and merge per call.
+        # Treat the returned dict as read-only.
+        base = self._base_reqs.get(system_prompt)
+        if base is None:
+            base = {"modelId": self.model_id}
+            if system_prompt: base["system"] = [{"text": system_prompt}]
+            self._base_reqs[system_prompt] = base
+        return base
 
     def _retry_without_tools_if_needed(self, fn, req: Dict[str, Any]):
         try:
@@ -63,8 +114,7 @@ class BedrockClient:
                  tools: Optional[List[Dict[str, Any]]] = None,
                  tool_config: Optional[Dict[str, Any]] = None,
                  inference_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        req: Dict[str, Any] = {"modelId": self.model_id, "messages": messages}
-        if system_prompt: req["system"] = [{"text": system_prompt}]
+        req: Dict[str, Any] = {**self._precomposed_req(system_prompt), "messages": messages}
         if tools: req["tools"] = tools
         if tool_config: req["toolConfig"] = tool_config
         if inference_config: req["inferenceConfig"] = inference_config
@@ -73,8 +123,7 @@ class BedrockClient:
     def converse_stream(self, system_prompt: Optional[str], messages: List[Dict[str, Any]],
                         tools: Optional[List[Dict[str, Any]]] = None,
                         inference_config: Optional[Dict[str, Any]] = None):
-        req: Dict[str, Any] = {"modelId": self.model_id, "messages": messages}
-        if system_prompt: req["system"] = [{"text": system_prompt}]
+        req: Dict[str, Any] = {**self._precomposed_req(system_prompt), "messages": messages}
         if tools: req["tools"] = tools
         if inference_config: req["inferenceConfig"] = inference_config
         return self._retry_without_tools_if_needed(self.client.converse_stream, req)
@@ -161,87 +210,141 @@ JSON_PLAN_SYSTEM = (
 )
 
 # =============================
-# Pydantic models
+# Request/response models (msgspec)
 # =============================
-class PlanRequest(BaseModel):
+class PlanRequest(msgspec.Struct):
     input: str
     context: Optional[Dict[str, Any]] = None
     session_id: Optional[str] = None
 
-class PlanResponse(BaseModel):
+class PlanResponse(msgspec.Struct):
     assistant_message: Optional[str] = None
     actions: List[Dict[str, Any]] = []
 
-class ChatSendRequest(BaseModel):
+class ChatSendRequest(msgspec.Struct, kw_only=True):
     session_id: Optional[str] = None
     user_input: str
     context: Optional[Dict[str, Any]] = None
 
-class ChatSendResponse(BaseModel):
+class ChatSendResponse(msgspec.Struct):
     session_id: str
     assistant_output: str
     history_len: int
 
-class CodeGenRequest(BaseModel):
+class CodeGenRequest(msgspec.Struct):
     instructions: str
     language: Optional[str] = None
     context: Optional[Dict[str, Any]] = None
     session_id: Optional[str] = None
 
-class CodeGenResponse(BaseModel):
+class CodeGenResponse(msgspec.Struct):
     files: List[Dict[str, str]]
 
+def _msgspec_body(model: type):
+    """Dependency that decodes the raw JSON body straight into `model`, bypassing Pydantic."""
+    decoder = msgspec.json.Decoder(model)
+    async def _decode(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except (msgspec.ValidationError, msgspec.DecodeError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    return _decode
+
+def _msgspec_response(obj: msgspec.Struct) -> Response:
+    return Response(content=msgspec.json.encode(obj), media_type="application/json")
+
+# FastAPI can't see msgspec types, so publish their schemas in the OpenAPI doc ourselves
+_, _MSGSPEC_COMPONENTS = msgspec.json.schema_components(
+    (PlanRequest, PlanResponse, ChatSendRequest, ChatSendResponse, CodeGenRequest, CodeGenResponse),
+    ref_template="#/components/schemas/{name}",
+)
+
+def _msgspec_openapi(req_model: type, resp_model: type) -> Dict[str, Any]:
+    """Route kwargs documenting a msgspec request body and 200 response."""
+    def _json(model: type) -> Dict[str, Any]:
+        return {"application/json": {"schema": {"$ref": f"#/components/schemas/{model.__name__}"}}}
+    return {
+        "openapi_extra": {"requestBody": {"required": True, "content": _json(req_model)}},
+        "responses": {
+            200: {"description": "Successful Response", "content": _json(resp_model)},
+            422: {"description": "Invalid request body"},
+        },
+    }
+
+_default_openapi = app.openapi
+
+def _openapi_with_msgspec() -> Dict[str, Any]:
+    if app.openapi_schema is None:
+        schema = _default_openapi()
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(_MSGSPEC_COMPONENTS)
+    return app.openapi_schema
+
+app.openapi = _openapi_with_msgspec
+
 # =============================
 # In-memory chat store
 # =============================
 _SESSIONS: Dict[str, List[Dict[str, Any]]] = {}
+_HISTORY_MAX_TURNS = 32  # user+assistant pairs kept per session
 
 def _new_session_id() -> str:
     return str(uuid.uuid4())
 
 def _get_history(session_id: str) -> List[Dict[str, Any]]:
-    return _SESSIONS.setdefault(session_id, [])
+    h = _SESSIONS.get(session_id)
+    if h is None:
+        h = []
+        _SESSIONS[session_id] = h
+    return h
 
 # =============================
 # Preview plumbing
 # =============================
 _PREVIEW_HTML: str = ""  # updated by /code/generate
 
-def _tsx_wrapper(tsx_filename: str, tsx_code: str) -> str:
-    return f"""<!doctype html>
+_TSX_HEAD = """<!doctype html>
 <html><head>
 <meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
-<title>{tsx_filename} preview</title>
-<style>html,body,#root{{height:100%;margin:0}}*,*:before,*:after{{box-sizing:border-box}}</style>
+"""
+_TSX_TITLE_FMT = "<title>%s preview</title>\n"
+_TSX_PRE = """<style>html,body,#root{height:100%;margin:0}*,*:before,*:after{box-sizing:border-box}</style>
 <script crossorigin src="https://unpkg.com/react@18/umd/react.development.js"></script>
 <script crossorigin src="https://unpkg.com/react-dom@18/umd/react-dom.development.js"></script>
 <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
 </head>
 <body><div id="root"></div>
 <script type="text/babel" data-presets="typescript,react">
-{tsx_code}
-try {{
+"""
+_TSX_POST = """
+try {
   const C = (typeof RootLayout!=='undefined'&&RootLayout) || (typeof App!=='undefined'&&App) || (typeof Layout!=='undefined'&&Layout);
   if (!C) throw new Error('No RootLayout/App/Layout export found to mount.');
-  ReactDOM.createRoot(document.getElementById('root')).render(React.createElement(C, {{}}));
-}} catch (e) {{
+  ReactDOM.createRoot(document.getElementById('root')).render(React.createElement(C, {}));
+} catch (e) {
   const pre = document.createElement('pre'); pre.textContent = 'Preview error:\\n' + String(e);
   document.body.appendChild(pre);
-}}
+}
 </script></body></html>"""
 
+def _tsx_wrapper(tsx_filename: str, tsx_code: str) -> str:
+    return "".join((_TSX_HEAD, _TSX_TITLE_FMT % tsx_filename, _TSX_PRE, tsx_code, _TSX_POST))
+
 def _choose_preview_html(files: List[Dict[str, str]]) -> str:
+    # Priority: index.html, then first .tsx (wrapped), then any .html
+    tsx: Optional[Dict[str, str]] = None
+    any_html: Optional[Dict[str, str]] = None
     for f in files:
         p = (f.get("path") or "").lower()
-        if p.endswith("index.html"):
-            return f.get("contents", "")
-    for f in files:
-        name = (f.get("path") or "").split("/")[-1]
-        if name in {"layout.tsx", "app.tsx", "App.tsx", "index.tsx"} or name.lower().endswith(".tsx"):
-            return _tsx_wrapper(f.get("path", ""), f.get("contents", ""))
-    for f in files:
-        if (f.get("path") or "").lower().endswith(".html"):
-            return f.get("contents", "")
+        if p.endswith(".html"):
+            if p.endswith("index.html"):
+                return f.get("contents", "")
+            if any_html is None: any_html = f
+        elif tsx is None and p.endswith(".tsx"):
+            tsx = f
+    if tsx is not None:
+        return _tsx_wrapper(tsx.get("path", ""), tsx.get("contents", ""))
+    if any_html is not None:
+        return any_html.get("contents", "")
     if files:
         first = files[0]
         return f"<pre>{first.get('path','(no path)')}\\n\\n{first.get('contents','')}</pre>"
@@ -257,51 +360,135 @@ _SHELL_PAGE = """<!doctype html>
 <style>html,body{height:100%;margin:0}*,*:before,*:after{box-sizing:border-box}body{overflow:auto}#root{min-height:100%}</style>
 <title>{title}</title></head><body><div id="root">{content}</div></body></html>"""
 
+def _split_shell(shell: str, title: str) -> Tuple[bytes, bytes]:
+    # Substitute the title once and split around {content}; the CSS braces in the
+    # shells are not format fields, so str.format can't be used on them.
+    pre, post = shell.replace("{title}", title).split("{content}")
+    return pre.encode(), post.encode()
+
+_SHELL_PREVIEW_PREFIX, _SHELL_PREVIEW_SUFFIX = _split_shell(_SHELL_PREVIEW, "Preview")
+_SHELL_PAGE_PREFIX, _SHELL_PAGE_SUFFIX = _split_shell(_SHELL_PAGE, "Full Page")
+
 @app.get("/preview")
 def preview():
-    html = _SHELL_PREVIEW.format(title="Preview", content=_PREVIEW_HTML or "<p>(no content yet)</p>")
-    return HTMLResponse(html)
+    body = (_PREVIEW_HTML or "<p>(no content yet)</p>").encode()
+    return HTMLResponse(_SHELL_PREVIEW_PREFIX + body + _SHELL_PREVIEW_SUFFIX)
 
 @app.get("/page")
 def page():
-    html = _SHELL_PAGE.format(title="Full Page", content=_PREVIEW_HTML or "<p>(no content yet)</p>")
-    return HTMLResponse(html)
+    body = (_PREVIEW_HTML or "<p>(no content yet)</p>").encode()
+    return HTMLResponse(_SHELL_PAGE_PREFIX + body + _SHELL_PAGE_SUFFIX)
 
 # =============================
 # TRACE BUS (SSE)
 # =============================
-SESSION_QUEUES: Dict[str, asyncio.Queue[Tuple[str, dict]]] = {}
+_QUEUE_MAXSIZE = 1024        # events buffered per session before the oldest is dropped
+_MAX_SESSION_QUEUES = 512    # least recently used sessions are evicted past this
+_QUEUE_IDLE_TTL = 600.0      # seconds without activity before the reaper drops a queue
+
+# Ordered by recency of use (oldest first)
+SESSION_QUEUES: "OrderedDict[str, asyncio.Queue[Tuple[str, dict]]]" = OrderedDict()
+_QUEUE_SEEN: Dict[str, float] = {}
+# Sessions with an open /trace/stream reader (open stream count); never evicted or reaped
+_STREAMING: Dict[str, int] = {}
+
+def _drop_queue(session_id: str):
+    SESSION_QUEUES.pop(session_id, None)
+    _QUEUE_SEEN.pop(session_id, None)
+
+def _touch_queue(session_id: str):
+    if session_id in SESSION_QUEUES:
+        SESSION_QUEUES.move_to_end(session_id)
+        _QUEUE_SEEN[session_id] = time.monotonic()
 
 def _get_queue(session_id: str) -> asyncio.Queue:
     q = SESSION_QUEUES.get(session_id)
     if q is None:
-        q = asyncio.Queue()
+        q = asyncio.Queue(maxsize=_QUEUE_MAXSIZE)
         SESSION_QUEUES[session_id] = q
+        excess = len(SESSION_QUEUES) - _MAX_SESSION_QUEUES
+        if excess > 0:
+            # Oldest first, skipping queues a live stream is reading from (and the new one)
+            victims = list(islice(
+                (sid for sid in SESSION_QUEUES if sid not in _STREAMING and sid != session_id), excess
+            ))
+            for sid in victims:
+                log.info("[trace] evicting queue session_id=%s", sid)
+                _drop_queue(sid)
+    else:
+        SESSION_QUEUES.move_to_end(session_id)
+    _QUEUE_SEEN[session_id] = time.monotonic()
     return q
 
-def trace(session_id: str, kind: str, payload: dict):
+def _enqueue_trace(session_id: str, kind: str, payload: dict):
     q = _get_queue(session_id)
-    q.put_nowait((kind, payload))
+    try:
+        q.put_nowait((kind, payload))
+    except asyncio.QueueFull:
+        # No one is draining this session; keep the newest events
+        q.get_nowait()
+        q.put_nowait((kind, payload))
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None  # the serving loop; bound at startup
+
+def trace(session_id: str, kind: str, payload: dict):
+    # Queues belong to the event loop; sync endpoints run in the threadpool and
+    # must hand their events over instead of touching the queue directly.
+    loop = _LOOP
+    if loop is not None:
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            loop.call_soon_threadsafe(_enqueue_trace, session_id, kind, payload)
+            return
+    _enqueue_trace(session_id, kind, payload)
+
+async def _reap_idle_queues():
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.monotonic() - _QUEUE_IDLE_TTL
+        idle = [sid for sid, seen in list(_QUEUE_SEEN.items()) if seen < cutoff and sid not in _STREAMING]
+        for sid in idle:
+            _drop_queue(sid)
+        if idle:
+            log.info("[trace] reaped %d idle queues", len(idle))
+
+_KEEPALIVE_INTERVAL = 15.0
 
 @app.get("/trace/stream")
-async def trace_stream(session_id: str):
+async def trace_stream(session_id: str, request: Request):
     log.info("[trace] open session_id=%s", session_id)
-    q = _get_queue(session_id)
 
     async def gen():
-        yield "event: hello\n" + f"data: {json.dumps({'ts': time.time()})}\n\n"
-        last_ping = time.time()
+        _STREAMING[session_id] = _STREAMING.get(session_id, 0) + 1
+        q = _get_queue(session_id)
         try:
+            yield b"event: hello\ndata: " + orjson.dumps({"ts": time.time()}) + b"\n\n"
             while True:
                 try:
-                    kind, payload = await asyncio.wait_for(q.get(), timeout=5.0)
-                    yield f"event: {kind}\n" + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                    # Wakes on the next event, or once per keepalive interval when idle
+                    kind, payload = await asyncio.wait_for(q.get(), timeout=_KEEPALIVE_INTERVAL)
+                    _touch_queue(session_id)
+                    try:
+                        data = orjson.dumps(payload)
+                    except TypeError as e:  # orjson.JSONEncodeError, e.g. ints beyond 64 bits
+                        # Report the unencodable event instead of tearing down the stream
+                        kind = "error"
+                        data = orjson.dumps({"where": "trace_stream", "message": str(e)})
+                    yield b"event: " + kind.encode() + b"\ndata: " + data + b"\n\n"
                 except asyncio.TimeoutError:
-                    yield ": keepalive\n\n"
-                    if time.time() - last_ping > 30:
-                        last_ping = time.time()
+                    if await request.is_disconnected():
+                        break
+                    _touch_queue(session_id)
+                    yield b": keepalive\n\n"
         finally:
-            SESSION_QUEUES.pop(session_id, None)
+            remaining = _STREAMING.pop(session_id, 1) - 1
+            if remaining > 0:
+                _STREAMING[session_id] = remaining
+            else:
+                _drop_queue(session_id)
             log.info("[trace] closed session_id=%s", session_id)
 
     return StreamingResponse(
@@ -315,8 +502,8 @@ async def trace_stream(session_id: str):
     )
 
 @app.get("/trace/stream/{session_id}")
-async def trace_stream_path(session_id: str):
-    return await trace_stream(session_id)
+async def trace_stream_path(session_id: str, request: Request):
+    return await trace_stream(session_id, request)
 
 @app.post("/trace/push")
 async def trace_push(
@@ -324,33 +511,40 @@ async def trace_push(
     kind: str = Body(..., embed=True),
     payload: dict = Body(default_factory=dict, embed=True),
 ):
-    _get_queue(session_id)
     trace(session_id, kind, payload)
-    return JSONResponse({"ok": True})
+    return {"ok": True}
 
 # =============================
 # Friendly assistant summaries
 # =============================
+_BTN_RE = re.compile(r"<button[^>]*>([^<]{1,40})</button>", re.I | re.S)
+_WS_RE = re.compile(r"\s+")
+_TW_COLOR_RE = re.compile(r"\b(bg|text|border)-([a-z]+)-\d{2,3}\b")
+_CSS_COLOR_RE = re.compile(r"color:\s*([^;}{]+)")
+_CSS_BG_RE = re.compile(r"background(?:-color)?:\s*([^;}{]+)")
+_P_TAG_RE = re.compile(r"<p[\s>]")
+_CLASSNAME_RE = re.compile(r"className=.*?(grid|flex|container)", re.I)
+
 def _peek(s: Optional[str]) -> str:
     if not s: return ""
-    t = re.sub(r"\s+", " ", s.strip())
+    t = " ".join(s.split())
     return t[:60] + ("…" if len(t) > 60 else "")
 
 def _guess_button_label(src: str) -> Optional[str]:
-    m = re.search(r"<button[^>]*>([^<]{1,40})</button>", src, flags=re.I|re.S)
+    m = _BTN_RE.search(src)
     if m:
         label = m.group(1).strip()
-        label = re.sub(r"\s+", " ", label)
+        label = _WS_RE.sub(" ", label)
         return label
     return None
 
 def _guess_color(src: str) -> Optional[str]:
     s = src.lower()
-    m = re.search(r"\b(bg|text|border)-([a-z]+)-\d{2,3}\b", s)
+    m = _TW_COLOR_RE.search(s)
     if m: return m.group(0)
-    m = re.search(r"color:\s*([^;}{]+)", s)
+    m = _CSS_COLOR_RE.search(s)
     if m: return f"color {m.group(1).strip()}"
-    m = re.search(r"background(?:-color)?:\s*([^;}{]+)", s)
+    m = _CSS_BG_RE.search(s)
     if m: return f"background {m.group(1).strip()}"
     return None
 
@@ -363,23 +557,27 @@ def _describe_contents(src: str) -> List[str]:
         else: hints.append("added/updated a button")
         c = _guess_color(src)
         if c: hints.append(f"with {c}")
-    if re.search(r"<h1[^>]*>", src, flags=re.I): hints.append("changed the main heading")
-    if re.search(r"<p[^>]*>", src, flags=re.I): hints.append("updated page copy")
-    if re.search(r"className=.*?(grid|flex|container)", src, flags=re.I): hints.append("adjusted layout")
+    # Cheap substring probes on the lowercased copy; only the layout check needs a regex
+    if "<h1" in low: hints.append("changed the main heading")
+    if "<p" in low and _P_TAG_RE.search(low): hints.append("updated page copy")
+    if "classname=" in low and _CLASSNAME_RE.search(src): hints.append("adjusted layout")
     return hints
 
 def build_assistant_message(user_text: str, actions: List[Dict[str, Any]]) -> str:
-    created = sum(1 for a in actions if a["type"] == "create_file")
-    updated = sum(1 for a in actions if a["type"] == "update_file")
-    deleted = sum(1 for a in actions if a["type"] == "delete_file")
-    ran = sum(1 for a in actions if a["type"] == "run_command")
-    paths = [a.get("path") for a in actions if a.get("path")]
-
+    kinds: Counter = Counter()
+    paths: List[str] = []
     insights: List[str] = []
     for a in actions:
-        if a["type"] in ("create_file", "update_file"):
-            cont = a.get("contents") or ""
-            insights.extend(_describe_contents(cont))
+        t = a["type"]
+        kinds[t] += 1
+        p = a.get("path")
+        if p: paths.append(p)
+        if t in ("create_file", "update_file"):
+            insights.extend(_describe_contents(a.get("contents") or ""))
+    created = kinds["create_file"]
+    updated = kinds["update_file"]
+    deleted = kinds["delete_file"]
+    ran = kinds["run_command"]
 
     touched = ", ".join(paths[:3]) + ("…" if len(paths) > 3 else "")
     head = "✅ changes applied" if (created + updated + deleted + ran) else "✅ no-op"
@@ -404,6 +602,39 @@ class _ToolCapture:
             if isinstance(acts, list):
                 self.actions = acts
 
+def _close_quietly(event_stream):
+    try:
+        event_stream.close()
+    except Exception as e:
+        log.debug("event stream close failed: %s", e)
+
+def _close_stream_off_loop(event_stream):
+    asyncio.get_running_loop().run_in_executor(None, _close_quietly, event_stream)
+
+def _discard_opened_stream(fut: asyncio.Future):
+    if fut.cancelled() or fut.exception() is not None: return
+    event_stream = fut.result().get("stream")
+    if event_stream is not None:
+        _close_stream_off_loop(event_stream)
+
+class _TokenCoalescer:
+    """Merges streamed text deltas into fewer "token" trace events."""
+    def __init__(self, session_id: str, max_parts: int = 8, max_delay: float = 0.05):
+        self.session_id = session_id
+        self.max_parts = max_parts
+        self.max_delay = max_delay
+        self.pending: List[str] = []
+        self.last_flush = time.monotonic()
+    def add(self, text: str):
+        self.pending.append(text)
+        if len(self.pending) >= self.max_parts or time.monotonic() - self.last_flush > self.max_delay:
+            self.flush()
+    def flush(self):
+        if self.pending:
+            trace(self.session_id, "token", {"text": "".join(self.pending)})
+            self.pending.clear()
+        self.last_flush = time.monotonic()
+
 def _context_blob(context: Optional[Dict[str, Any]], char_budget: int = 10000) -> str:
     if not context or "files" not in context: return ""
     files = context["files"]
@@ -419,14 +650,16 @@ def _context_blob(context: Optional[Dict[str, Any]], char_budget: int = 10000) -
         if used >= char_budget: break
     return "".join(chunks)
 
-def _json_only_plan(session_id: str, user_text: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+async def _json_only_plan(session_id: str, user_text: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
     trace(session_id, "step", {"msg": "json-plan.start"})
     snapshot = _context_blob(context)
     prompt = f"User request:\n{user_text}\n\nProject snapshot:\n{snapshot}\n\nReturn ONLY the JSON per schema."
 
     messages = [{"role": "user", "content": [{"text": prompt}]}]
     try:
-        resp = brx.converse(JSON_PLAN_SYSTEM, messages, tools=None, inference_config={"temperature": 0.2})
+        resp = await asyncio.to_thread(
+            brx.converse, JSON_PLAN_SYSTEM, messages, tools=None, inference_config={"temperature": 0.2}
+        )
         out = resp.get("output", {})
         parts = out.get("message", {}).get("content", [])
         text = "\n".join([p.get("text", "") for p in parts if p.get("text")]).strip()
@@ -438,7 +671,7 @@ def _json_only_plan(session_id: str, user_text: str, context: Optional[Dict[str,
         end = text.rfind("}")
         if start >= 0 and end > start:
             text = text[start:end+1]
-        data = json.loads(text)
+        data = orjson.loads(text)
         acts = data.get("actions", [])
         if isinstance(acts, list):
             trace(session_id, "step", {"msg": "json-plan.ok", "count": len(acts)})
@@ -449,6 +682,19 @@ def _json_only_plan(session_id: str, user_text: str, context: Optional[Dict[str,
         trace(session_id, "error", {"where": "json_plan", "message": str(e)})
         return []
 
+def _ctx_preview(ctx: Dict[str, Any], budget: int = 1000) -> str:
+    """JSON-ish preview of ctx, serializing top-level keys only until budget is reached."""
+    parts: List[bytes] = []
+    used = 1
+    for k, v in ctx.items():
+        if k == "files" and isinstance(v, dict):
+            v = list(islice(v, 10))  # file names only; contents can be megabytes
+        item = orjson.dumps(str(k)) + b":" + orjson.dumps(v)
+        parts.append(item)
+        used += len(item) + 1
+        if used >= budget: break
+    return (b"{" + b",".join(parts) + b"}").decode()[:budget]
+
 def _synthesize_minimal_action(user_text: str) -> List[Dict[str, Any]]:
     safe_text = user_text.replace("<", "&lt;").replace(">", "&gt;")
     tsx = f"""export default function Page() {{
@@ -467,8 +713,8 @@ def _synthesize_minimal_action(user_text: str) -> List[Dict[str, Any]]:
 # =============================
 # Endpoints
 # =============================
-@app.post("/invocations", response_model=PlanResponse)
-def plan_endpoint(req: PlanRequest):
+@app.post("/invocations", **_msgspec_openapi(PlanRequest, PlanResponse))
+async def plan_endpoint(req: PlanRequest = Depends(_msgspec_body(PlanRequest))):
     """
     Planner with streaming traces.
     If no tool actions are returned, run a JSON-only planning pass (with context),
@@ -482,58 +728,83 @@ def plan_endpoint(req: PlanRequest):
         trace(session_id, "step", {"msg": "planning.start"})
         trace(session_id, "model.start", {"model": MODEL_ID, "phase": "plan"})
 
-        assistant_chunks: List[str] = []
         capture = _ToolCapture()
+        tokens = _TokenCoalescer(session_id)
 
         async def _run_stream():
-            stream = brx.converse_stream(
-                PLANNER_SYSTEM, messages, tools=EMIT_PLAN_TOOL, inference_config={"temperature": 0.2}
-            )
-            for ev in stream.get("stream"):
-                if "contentBlockDelta" in ev:
-                    delta = ev["contentBlockDelta"].get("delta", {})
-                    if "text" in delta:
-                        t = delta["text"]; assistant_chunks.append(t)
-                        trace(session_id, "token", {"text": t})
-                    if "toolUse" in delta:
-                        trace(session_id, "tool.delta", delta["toolUse"])
-                if "contentBlockStart" in ev:
-                    start = ev["contentBlockStart"].get("start", {})
-                    if "toolUse" in start: trace(session_id, "tool.start", start["toolUse"])
-                if "contentBlockStop" in ev:
-                    stop = ev["contentBlockStop"].get("stop", {})
-                    if "toolUse" in stop: trace(session_id, "tool.stop", stop["toolUse"])
-                if "message" in ev:
-                    for part in ev["message"].get("content", []):
-                        capture.absorb(part)
-                        if part.get("text"):
-                            t = part["text"]; assistant_chunks.append(t)
-                            trace(session_id, "token", {"text": t})
-                if "metadata" in ev and "usage" in ev["metadata"]:
-                    u = ev["metadata"]["usage"]
-                    trace(session_id, "meta", {"inputTokens": u.get("inputTokens"), "outputTokens": u.get("outputTokens")})
-                if "messageStop" in ev:
-                    trace(session_id, "model.stop", {"phase": "plan"})
+            opening = asyncio.ensure_future(asyncio.to_thread(
+                brx.converse_stream,
+                PLANNER_SYSTEM, messages, tools=EMIT_PLAN_TOOL, inference_config={"temperature": 0.2},
+            ))
+            try:
+                stream = await asyncio.shield(opening)
+            except asyncio.CancelledError:
+                # Timed out before the call returned; close its stream whenever it does
+                opening.add_done_callback(_discard_opened_stream)
+                raise
+            # botocore's event stream blocks on the socket; pull one event at a time
+            # off-loop so other requests keep being served while this one streams.
+            event_stream = stream.get("stream")
+            events = iter(event_stream)
+            try:
+                while True:
+                    ev = await asyncio.to_thread(next, events, None)
+                    if ev is None: break
+                    if "contentBlockDelta" in ev:
+                        delta = ev["contentBlockDelta"].get("delta", {})
+                        if "text" in delta:
+                            tokens.add(delta["text"])
+                        if "toolUse" in delta:
+                            tokens.flush()
+                            trace(session_id, "tool.delta", delta["toolUse"])
+                    if "contentBlockStart" in ev:
+                        start = ev["contentBlockStart"].get("start", {})
+                        if "toolUse" in start:
+                            tokens.flush()
+                            trace(session_id, "tool.start", start["toolUse"])
+                    if "contentBlockStop" in ev:
+                        stop = ev["contentBlockStop"].get("stop", {})
+                        if "toolUse" in stop:
+                            tokens.flush()
+                            trace(session_id, "tool.stop", stop["toolUse"])
+                    if "message" in ev:
+                        for part in ev["message"].get("content", []):
+                            capture.absorb(part)
+                            if part.get("text"):
+                                tokens.add(part["text"])
+                    if "metadata" in ev and "usage" in ev["metadata"]:
+                        tokens.flush()
+                        u = ev["metadata"]["usage"]
+                        trace(session_id, "meta", {"inputTokens": u.get("inputTokens"), "outputTokens": u.get("outputTokens")})
+                    if "messageStop" in ev:
+                        tokens.flush()
+                        trace(session_id, "model.stop", {"phase": "plan"})
+            finally:
+                tokens.flush()
+                # On timeout a worker may still be blocked in next() holding the reader
+                # lock, so close() would block too; run it off-loop and don't wait.
+                _close_stream_off_loop(event_stream)
 
         # ⏱ Timebox streaming; if it stalls, fallback to non-stream
         try:
-            asyncio.get_event_loop().run_until_complete(asyncio.wait_for(_run_stream(), timeout=20))
+            await asyncio.wait_for(_run_stream(), timeout=20)
         except Exception as stream_err:
             log.warning("Streaming timed out or failed, falling back: %s", stream_err)
-            resp = brx.converse(PLANNER_SYSTEM, messages, tools=EMIT_PLAN_TOOL, inference_config={"temperature": 0.2})
+            resp = await asyncio.to_thread(
+                brx.converse, PLANNER_SYSTEM, messages, tools=EMIT_PLAN_TOOL, inference_config={"temperature": 0.2}
+            )
             out = resp.get("output", {})
             parts = out.get("message", {}).get("content", [])
             for p in parts:
                 if p.get("text"):
-                    t = p["text"]; assistant_chunks.append(t)
-                    trace(session_id, "token", {"text": t})
+                    trace(session_id, "token", {"text": p["text"]})
                 capture.absorb(p)
             trace(session_id, "model.stop", {"phase": "plan"})
 
         actions: List[Dict[str, Any]] = capture.actions
 
         if not actions:
-            actions = _json_only_plan(session_id, user_text, req.context)
+            actions = await _json_only_plan(session_id, user_text, req.context)
 
         if not actions:
             trace(session_id, "step", {"msg": "synthesize.minimal"})
@@ -544,20 +815,21 @@ def plan_endpoint(req: PlanRequest):
         # ✅ Friendly assistant message
         short_msg = build_assistant_message(user_text, actions)
 
-        return PlanResponse(assistant_message=short_msg, actions=actions)
+        return _msgspec_response(PlanResponse(assistant_message=short_msg, actions=actions))
 
     except Exception as e:
         trace(session_id, "error", {"where": "invocations", "message": str(e)})
         log.exception("Planner error")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/chat/send", response_model=ChatSendResponse)
-def chat_send(req: ChatSendRequest):
+@app.post("/chat/send", **_msgspec_openapi(ChatSendRequest, ChatSendResponse))
+def chat_send(req: ChatSendRequest = Depends(_msgspec_body(ChatSendRequest))):
     try:
         session_id = req.session_id or _new_session_id()
         history = _get_history(session_id)
 
-        messages = history + [{"role": "user", "content": [{"text": req.user_input}]}]
+        user_turn = {"role": "user", "content": [{"text": req.user_input}]}
+        messages = [*history, user_turn]
         trace(session_id, "model.start", {"model": MODEL_ID, "phase": "chat"})
         resp = brx.converse(CHAT_SYSTEM, messages)
         out = resp.get("output", {})
@@ -567,22 +839,24 @@ def chat_send(req: ChatSendRequest):
         trace(session_id, "token", {"text": assistant_text})
         trace(session_id, "model.stop", {"phase": "chat"})
 
-        history.append({"role": "user", "content": [{"text": req.user_input}]})
+        # history is the live list held in _SESSIONS; mutate it in place
+        history.append(user_turn)
         history.append({"role": "assistant", "content": [{"text": assistant_text}]})
-        _SESSIONS[session_id] = history
+        if len(history) > 2 * _HISTORY_MAX_TURNS:
+            del history[:-2 * _HISTORY_MAX_TURNS]
 
-        return ChatSendResponse(session_id=session_id, assistant_output=assistant_text, history_len=len(history))
+        return _msgspec_response(ChatSendResponse(session_id=session_id, assistant_output=assistant_text, history_len=len(history)))
     except Exception as e:
         trace(req.session_id or "(no-session)", "error", {"where": "chat_send", "message": str(e)})
         log.exception("Chat error")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/code/generate", response_model=CodeGenResponse)
-def code_generate(req: CodeGenRequest):
+@app.post("/code/generate", **_msgspec_openapi(CodeGenRequest, CodeGenResponse))
+def code_generate(req: CodeGenRequest = Depends(_msgspec_body(CodeGenRequest))):
     try:
         prompt_lines = [req.instructions]
         if req.language: prompt_lines.append(f"Preferred language: {req.language}")
-        if req.context:  prompt_lines.append(f"Context: {json.dumps(req.context)[:1000]}")
+        if req.context:  prompt_lines.append(f"Context: {_ctx_preview(req.context)}")
         messages = [{"role": "user", "content": [{"text": "\n\n".join(prompt_lines)}]}]
 
         trace(req.session_id or "(no-session)", "model.start", {"model": MODEL_ID, "phase": "codegen"})
@@ -611,7 +885,7 @@ def code_generate(req: CodeGenRequest):
             trace(req.session_id, "plan", {"ops": ops})
             trace(req.session_id, "model.stop", {"phase": "codegen"})
 
-        return CodeGenResponse(files=files)
+        return _msgspec_response(CodeGenResponse(files=files))
     except Exception as e:
         trace(req.session_id or "(no-session)", "error", {"where": "code_generate", "message": str(e)})
         log.exception("Codegen error")
@@ -619,7 +893,7 @@ def code_generate(req: CodeGenRequest):
 
 @app.get("/chat/history/{session_id}")
 def chat_history(session_id: str):
-    return JSONResponse(content={"session_id": session_id, "history": _SESSIONS.get(session_id, [])})
+    return {"session_id": session_id, "history": _SESSIONS.get(session_id, [])}
 
 @app.get("/healthz")
 def healthz():